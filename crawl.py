@@ -1,14 +1,30 @@
 """Crawl the data."""
 import argparse
-import json
+import hashlib
+import itertools
 import logging
+import math
+import mmap
+import os
 import pathlib
+import sqlite3
 import sys
+import threading
 import time
-from typing import Callable, Union
+import urllib.parse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Callable, Iterable, List, Optional, Union
 
 import boto3
+import orjson
 import tqdm
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 
 def parse_args(args=None, namespace=None):
@@ -20,6 +36,16 @@ def parse_args(args=None, namespace=None):
         default="crawler-dev-crawl",
         help="AWS Lambda function name",
     )
+    parser.add_argument(
+        "--seen_table",
+        help="DynamoDB table shared by all crawlers to skip the URLs that "
+        "have been crawled (e.g., `example-crawler-dev-seen`)",
+    )
+    parser.add_argument(
+        "--qualifier",
+        help="AWS Lambda alias with provisioned concurrency (e.g., "
+        "`provisioned` as created by the Serverless Framework)",
+    )
     parser.add_argument(
         "-i",
         "--in_filename",
@@ -34,12 +60,64 @@ def parse_args(args=None, namespace=None):
         type=pathlib.Path,
         help="output directory to store the crawled data",
     )
+    parser.add_argument(
+        "--url_prefix_len",
+        type=int,
+        help="length of the common prefix of the URLs (if set, the data of "
+        "a URL is named by the rest of the URL)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=128,
+        type=int,
+        help="number of concurrent Lambda invocations (should not exceed "
+        "the account concurrency limit)",
+    )
+    parser.add_argument(
+        "-n",
+        "--batch_size",
+        default=10,
+        type=int,
+        help="maximum number of URLs to crawl per Lambda invocation (a batch "
+        "should be crawled within the function timeout and its results "
+        "should fit in the 6 MB response payload limit; batches are also "
+        "split to fit in the 256 KB request payload limit)",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket",
+        help="S3 bucket to store the results (invoke asynchronously if set)",
+    )
+    parser.add_argument(
+        "-c",
+        "--collect",
+        action="store_true",
+        help="collect the results from the S3 bucket instead of crawling",
+    )
+    parser.add_argument(
+        "--fanout",
+        action="store_true",
+        help="have the Lambda functions invoke the Lambda functions that "
+        "crawl the URLs (requires --bucket)",
+    )
+    parser.add_argument(
+        "--bloom",
+        action="store_true",
+        help="keep track of the crawled URLs with a Bloom filter to save "
+        "memory (a small fraction of URLs might be skipped)",
+    )
     parser.add_argument("-p", "--profile", help="AWS profile")
     parser.add_argument("-r", "--region", help="AWS Lambda region")
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="show warnings only"
     )
-    return parser.parse_args(args=args, namespace=namespace)
+    args = parser.parse_args(args=args, namespace=namespace)
+    if args.collect and args.bucket is None:
+        parser.error("--collect requires --bucket")
+    if args.fanout and args.bucket is None:
+        parser.error("--fanout requires --bucket")
+    return args
 
 
 def setup_loggers(log_dir: str, quiet: bool):
@@ -65,11 +143,152 @@ def setup_loggers(log_dir: str, quiet: bool):
     logging.getLogger("urllib3").setLevel(logging.ERROR)
 
 
+# Maximum payload size of asynchronous invocations (256 KB), which is also
+# well below that of synchronous invocations (6 MB)
+MAX_PAYLOAD_SIZE = 256 * 1024
+
+
+def batch_urls(
+    urls: Iterable[str],
+    batch_size: int,
+    max_payload_size: int = MAX_PAYLOAD_SIZE,
+):
+    """Group the URLs into batches that fit in an invocation payload."""
+    batch = []
+    # Leave some room for the other fields in the payload
+    payload_size = 1024
+    for url in urls:
+        # Account for the quotes, comma and space around the URL
+        url_size = len(url.encode()) + 4
+        if batch and (
+            len(batch) >= batch_size
+            or payload_size + url_size > max_payload_size
+        ):
+            yield batch
+            batch = []
+            payload_size = 1024
+        batch.append(url)
+        payload_size += url_size
+    if batch:
+        yield batch
+
+
+# Number of consecutive URLs within which the URLs are grouped by host
+HOST_GROUP_SIZE = 10000
+
+
+def group_by_host(urls: Iterable[str], group_size: int = HOST_GROUP_SIZE):
+    """Group the URLs by host within every `group_size` consecutive URLs.
+
+    This lets the warm Lambda containers reuse their connections to the same
+    host, without loading all the URLs into memory for a global sort.
+
+    """
+    iterator = iter(urls)
+    while group := list(itertools.islice(iterator, group_size)):
+        group.sort(key=lambda url: urllib.parse.urlsplit(url).netloc)
+        yield from group
+
+
+def count_lines(filename: Union[str, pathlib.Path]) -> int:
+    """Return the number of lines in a file."""
+    with open(filename, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def imap_unordered(
+    executor: Executor, func: Callable, iterable: Iterable, max_pending: int
+):
+    """Map a function over an iterable with a bounded number of tasks.
+
+    Unlike `Executor.map`, the iterable is consumed lazily (at most
+    `max_pending` items are submitted at a time) and the results are yielded
+    as they are completed.
+
+    """
+    iterator = iter(iterable)
+    futures = set()
+    while True:
+        for item in itertools.islice(iterator, max_pending - len(futures)):
+            futures.add(executor.submit(func, item))
+        if not futures:
+            return
+        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+# How long a URL stays in the table shared by all crawlers (in seconds)
+SEEN_TTL = 30 * 24 * 60 * 60
+
+
+def url_hash(url: str) -> bytes:
+    """Return the hash of a URL."""
+    return hashlib.blake2b(url.encode(), digest_size=16).digest()
+
+
+def iter_records(filename: Union[str, pathlib.Path]):
+    """Iterate over the records in a JSON-lines file.
+
+    Malformed lines (e.g., truncated by a crash or a full disk) are skipped
+    with a warning.
+
+    """
+    with open(filename, "rb") as f:
+        # Memory-mapping an empty file is not allowed
+        if not f.seek(0, 2):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i, line in enumerate(iter(mm.readline, b""), 1):
+                try:
+                    record = orjson.loads(line)
+                    if isinstance(record, dict) and "u" in record:
+                        yield record
+                        continue
+                except orjson.JSONDecodeError:
+                    pass
+                logging.warning(f"Skipped malformed line {i} in {filename}")
+
+
+# Files in which older versions kept track of the crawled and failed URLs
+LEGACY_FILENAMES = ("crawled-urls.txt", "failed-urls.txt", "crawled-urls.bin")
+
+
+def iter_legacy_hashes(filename: pathlib.Path):
+    """Iterate over the URL hashes in a file written by older versions."""
+    # Hashes of the crawled URLs
+    if filename.suffix == ".bin":
+        with open(filename, "rb") as f:
+            while len(h := f.read(16)) == 16:
+                yield h
+        return
+    with open(filename) as f:
+        for line in f:
+            # Failed URLs followed by their status codes
+            if filename.name == "failed-urls.txt":
+                yield url_hash(line.rstrip("\n").rsplit(",", 1)[0])
+            # Crawled URLs
+            else:
+                yield url_hash(line.strip())
+
+
 def example_name_func(url):
     """Return the name of file given a URL."""
     return f"{url.split('/')[-1]}.json"
 
 
+def make_name_func(prefix_len: int, suffix: str = ".json") -> Callable:
+    """Return a name function that strips a fixed-length prefix of a URL.
+
+    The function is generated at runtime with the prefix length and the
+    suffix inlined as constants, so it does not split the URL on every call.
+
+    """
+    source = f"lambda url: url[{int(prefix_len)}:] + {suffix!r}"
+    # pylint: disable-next=eval-used
+    return eval(compile(source, "<name_func>", "eval"))
+
+
 class Crawler:
     def __init__(
         self,
@@ -77,95 +296,413 @@ class Crawler:
         in_filename: Union[str, pathlib.Path],
         out_dir: Union[str, pathlib.Path],
         name_func: Callable,
+        bucket: Optional[str] = None,
+        use_bloom: bool = False,
+        qualifier: Optional[str] = None,
+        seen_table: Optional[str] = None,
     ):
         logging.info("Creating the crawler...")
         self.function_name = function_name
+        self.qualifier = qualifier
+        self.seen_table = seen_table
         self.out_dir = pathlib.Path(out_dir)
         self.name_func = name_func
+        self.bucket = bucket
+
+        # Set up the fields sent along with the URLs in each invocation
+        # (The function only stores the results in S3 and checks the shared
+        # table for crawled URLs if they are given.)
+        self.payload = {}
+        if bucket is not None:
+            self.payload["bucket"] = bucket
+        if seen_table is not None:
+            self.payload["seen_table"] = seen_table
+
+        # Invoke the function through its alias (if any), which has the
+        # provisioned concurrency
+        if qualifier is None:
+            self.invoked_name = function_name
+        else:
+            self.invoked_name = f"{function_name}:{qualifier}"
+
+        # Set up the client configuration
+        # (Raise the connection pool size so that the worker threads do not
+        # wait on each other for a connection, back off adaptively when
+        # throttled and keep the idle connections alive during resets.)
+        config = Config(
+            max_pool_connections=256,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True,
+        )
 
         # Get the Lambda client
-        self.client = boto3.client("lambda")
+        self.client = boto3.client("lambda", config=config)
+
+        # Get the S3 client to collect the results of asynchronous invocations
+        if self.bucket is not None:
+            self.s3_client = boto3.client("s3", config=config)
+
+        # Get the DynamoDB client to share the crawled URLs with the other
+        # crawlers
+        if self.seen_table is not None:
+            self.dynamodb_client = boto3.client("dynamodb", config=config)
+
+        # Count the URLs (they are read lazily by `iter_urls`)
+        self.in_filename = pathlib.Path(in_filename)
+        self.num_urls = count_lines(self.in_filename)
+
+        # Set up a database to store the crawled data
+        # (This avoids creating a small file for each URL.)
+        self.db = sqlite3.connect(
+            self.out_dir / "results.sqlite",
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(url TEXT PRIMARY KEY, name TEXT NOT NULL, data BLOB NOT NULL)"
+        )
+
+        # Set up the set of the hashes of the crawled or failed URLs
+        # (A Bloom filter uses much less memory, at the cost of skipping a
+        # small fraction of URLs due to false positives.)
+        if use_bloom:
+            # Import here as it is only required when using a Bloom filter
+            from pybloom_live import ScalableBloomFilter
+
+            self.seen = ScalableBloomFilter(
+                initial_capacity=max(self.num_urls, 1), error_rate=1e-4
+            )
+        else:
+            self.seen = set()
+
+        # Set up a log to keep track of the crawled and failed URLs
+        log_filename = self.out_dir / "crawl-log.jsonl"
+
+        # Load the hashes of the crawled and failed URLs
+        if log_filename.is_file():
+            for record in iter_records(log_filename):
+                self.seen.add(url_hash(record["u"]))
+
+            # Terminate a truncated last line so that it does not corrupt the
+            # next record
+            with open(log_filename, "rb+") as f:
+                if f.seek(0, 2):
+                    f.seek(-1, 2)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+
+        # Load the hashes of the URLs recorded by older versions
+        # (These files are no longer written.)
+        for name in LEGACY_FILENAMES:
+            legacy_filename = self.out_dir / name
+            if legacy_filename.is_file():
+                count = 0
+                for h in iter_legacy_hashes(legacy_filename):
+                    self.seen.add(h)
+                    count += 1
+                logging.info(f"Loaded {count} URLs from {legacy_filename}")
+
+        # Open the log in append mode
+        # (Each record is written with a single unbuffered write, which is
+        # atomic with O_APPEND, so the worker threads need no lock.)
+        self.log_fd = os.open(
+            log_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+
+        # Lock that guards the database shared by the worker threads
+        self.lock = threading.Lock()
+
+        # Thread that resets the client in the background
+        self.reset_thread = None
 
-        # Get URLs
-        self.urls = []
-        with open(pathlib.Path(in_filename)) as f:
+        # Version the alias was last pointed to (whose provisioned
+        # concurrency might not be ready yet), and the version it replaced
+        # (deleted on the next reset once its requests have finished)
+        self.pending_version = None
+        self.stale_version = None
+
+    def iter_urls(self):
+        """Iterate over the URLs in the input file."""
+        with open(self.in_filename) as f:
             for line in f:
-                self.urls.append(line.strip())
+                yield line.strip()
+
+    def iter_pending(self, pbar: Optional[tqdm.tqdm] = None):
+        """Iterate over the URLs that have not been crawled or once failed."""
+        for url in self.iter_urls():
+            if self.is_done(url):
+                # Count the skipped URL in the progress bar
+                if pbar is not None:
+                    pbar.update()
+                continue
+            yield url
+
+    def is_done(self, url: str) -> bool:
+        """Return whether a URL has been crawled or once failed."""
+        return url_hash(url) in self.seen
+
+    def record(self, url: str, status_code: int, ok: bool):
+        """Append a record of a crawled or failed URL to the log."""
+        record = {"u": url, "s": status_code, "t": "ok" if ok else "fail"}
+        os.write(self.log_fd, orjson.dumps(record) + b"\n")
+
+    def get_provisioned_status(self):
+        """Return the status of the provisioned concurrency of the alias."""
+        return self.client.get_provisioned_concurrency_config(
+            FunctionName=self.function_name, Qualifier=self.qualifier
+        )["Status"]
+
+    def wait_until_ready(self):
+        """Wait for the provisioned concurrency of the alias to be ready."""
+        if self.qualifier is None:
+            return
+        logging.info("Waiting for the provisioned concurrency...")
+        while True:
+            status = self.get_provisioned_status()
+            if status == "READY":
+                return
+            if status == "FAILED":
+                raise RuntimeError(
+                    "Failed to allocate the provisioned concurrency for "
+                    f"{self.invoked_name}"
+                )
+            time.sleep(5)
 
-        # Make sure the crawled directory exists
-        self.crawled_dir = self.out_dir / "crawled"
-        self.crawled_dir.mkdir(exist_ok=True)
+    def check_pending_version(self):
+        """Log once the provisioned concurrency of a reset is ready.
 
-        # Set up a file to keep track of the crawled URLs
-        crawled_urls_filename = self.out_dir / "crawled-urls.txt"
+        This never blocks, so it can be polled while crawling.
 
-        # Load the crawled URLs
-        if crawled_urls_filename.is_file():
-            with open(crawled_urls_filename) as f:
-                self.crawled_urls = set(line.strip() for line in f)
-        else:
-            # Create an empty file if it does not exist
-            crawled_urls_filename.touch()
-            # Set crawled URLs to an empty set
-            self.crawled_urls = set()
-
-        # Set up a file to keep track of the failed URLs
-        failed_urls_filename = self.out_dir / "failed-urls.txt"
-
-        # Load the failed URLs
-        if failed_urls_filename.is_file():
-            with open(failed_urls_filename) as f:
-                self.failed_urls = set(line.split(",")[0] for line in f)
+        """
+        version = self.pending_version
+        if version is None:
+            return
+        try:
+            status = self.get_provisioned_status()
+        except (BotoCoreError, ClientError):
+            logging.debug(
+                "Failed to get the provisioned concurrency status",
+                exc_info=True,
+            )
+            return
+        if status == "READY":
+            logging.debug(f"Provisioned concurrency of {version} is ready")
+        elif status == "FAILED":
+            logging.warning(
+                f"Failed to allocate the provisioned concurrency of {version}"
+                f" for {self.invoked_name}"
+            )
         else:
-            # Create an empty file if it does not exist
-            failed_urls_filename.touch()
-            # Set failed URLs to an empty set
-            self.failed_urls = set()
-
-        # Open the files in append mode
-        self.crawled_urls_file = open(crawled_urls_filename, "a")
-        self.failed_urls_file = open(failed_urls_filename, "a")
+            return
+        # Clear it unless another reset has taken place in the meantime
+        if self.pending_version == version:
+            self.pending_version = None
 
     def reset_client(self):
-        """Reset the client (a new IP will be assigned)."""
-        logging.debug("Resetting the crawler...")
-        # Update the function configuration
-        # (This will force the client to cold start and get a new IP.)
-        self.client.update_function_configuration(
-            FunctionName=self.function_name,
-            Description=f"Crawler-{int(time.time())}",
-        )
-        # Wait a while for it to take effect
-        time.sleep(60)
+        """Reset the client in the background (a new IP will be assigned).
+
+        The workers keep crawling with the old Lambda instances until the
+        update takes effect. A reset is skipped if another is in progress.
+        Return whether a reset has been started.
+
+        """
+        # Skip if a reset is already in progress
+        if self.reset_thread is not None and self.reset_thread.is_alive():
+            logging.debug("Skipped resetting as a reset is in progress")
+            return False
+
+        def reset():
+            """Update the function configuration and wait for it."""
+            logging.debug("Resetting the crawler...")
+            try:
+                # Update the function configuration
+                # (This will force the client to cold start and get a new IP.)
+                self.client.update_function_configuration(
+                    FunctionName=self.function_name,
+                    Description=f"Crawler-{int(time.time())}",
+                )
+                # Wait for it to take effect
+                self.client.get_waiter("function_updated").wait(
+                    FunctionName=self.function_name
+                )
+
+                # Point the alias to a new version so that its provisioned
+                # instances are replaced
+                # (Lambda deallocates the provisioned concurrency of the old
+                # version, so the requests are served by cold instances until
+                # that of the new version is ready. This is not waited for
+                # here so that the next reset is not held back; the readiness
+                # is polled by check_pending_version instead.)
+                if self.qualifier is not None:
+                    old_version = self.client.get_alias(
+                        FunctionName=self.function_name, Name=self.qualifier
+                    )["FunctionVersion"]
+                    version = self.client.publish_version(
+                        FunctionName=self.function_name
+                    )["Version"]
+                    self.client.update_alias(
+                        FunctionName=self.function_name,
+                        Name=self.qualifier,
+                        FunctionVersion=version,
+                    )
+                    self.pending_version = version
+
+                    # Delete the version replaced by the previous reset so
+                    # that they do not pile up
+                    # (The one just replaced might still be serving requests.)
+                    stale_version = self.stale_version
+                    if old_version not in ("$LATEST", version):
+                        self.stale_version = old_version
+                    if stale_version not in (None, old_version, version):
+                        try:
+                            self.client.delete_function(
+                                FunctionName=self.function_name,
+                                Qualifier=stale_version,
+                            )
+                        except Exception:  # pylint: disable=broad-except
+                            logging.warning(
+                                f"Failed to delete version {stale_version} "
+                                f"of {self.function_name}",
+                                exc_info=True,
+                            )
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to reset the crawler")
+            else:
+                logging.debug("Reset the crawler")
+
+        self.reset_thread = threading.Thread(target=reset, daemon=True)
+        self.reset_thread.start()
+        return True
+
+    def crawl(self, urls: List[str], test: bool = False):
+        """Crawl a batch of URLs."""
+        # Invoke Lambda function asynchronously if the results are to be
+        # stored in S3 (they will be collected later by `collect`)
+        if self.bucket is not None:
+            response = self.client.invoke(
+                FunctionName=self.invoked_name,
+                InvocationType="Event",
+                Payload=orjson.dumps({"urls": urls, **self.payload}),
+            )
+            return [response["StatusCode"]] * len(urls)
 
-    def crawl(self, url: str, test: bool = False):
-        """Crawl a URL."""
         # Invoke Lambda function
         response = self.client.invoke(
-            FunctionName=self.function_name,
-            Payload=f'{{"url": "{url}"}}',
+            FunctionName=self.invoked_name,
+            Payload=orjson.dumps({"urls": urls, **self.payload}),
         )
 
-        # Log the failure with its error message
-        if response["StatusCode"] != 200:
+        # Log the failure without reading the error payload
+        # (Lambda reports function errors, e.g., timeouts, with a status code
+        # of 200 and the error type in the `FunctionError` field.)
+        if "FunctionError" in response or response["StatusCode"] != 200:
+            response["Payload"].close()
             logging.debug(
-                f"Failed on {url} with the following error:\n"
-                f"{response['FunctionError']}"
+                f"Failed on {urls} with function error: "
+                f"{response.get('FunctionError')}"
             )
-            return response["StatusCode"]
+            return [None] * len(urls)
 
         # Read the return payload
-        payload = response["Payload"].read().decode("utf-8")
+        payload = response["Payload"].read()
 
         # Parse the output into a dictionary (assuming JSON format)
-        data = json.loads(payload)
+        data = orjson.loads(payload)
 
         # Handle bad return payload
-        if "status_code" not in data:
+        if "results" not in data:
             logging.debug(
-                f"Failed on {url} with bad return payload: {payload}"
+                f"Failed on {urls} with bad return payload: "
+                f"{payload.decode('utf-8')}"
+            )
+            return [response["StatusCode"]] * len(urls)
+
+        status_codes = [
+            self.save(url, result, test=test)
+            for url, result in zip(urls, data["results"])
+        ]
+
+        # Mark the recorded URLs as crawled for the other crawlers
+        if not test and self.seen_table is not None:
+            self.mark_done(
+                [
+                    url
+                    for url, status_code in zip(urls, status_codes)
+                    if status_code is not None
+                    and status_code not in (304, 403)
+                ]
             )
-            return response["StatusCode"]
+
+        return status_codes
+
+    def mark_done(self, urls: List[str]):
+        """Mark the URLs as crawled in the table shared by all crawlers.
+
+        Failures are only logged, as the URLs have been recorded locally
+        anyway (the other crawlers might crawl them again).
+
+        """
+        # Remove duplicates, which are not allowed in a batch write
+        hashes = list(dict.fromkeys(url_hash(url) for url in urls))
+        expires_at = str(int(time.time()) + SEEN_TTL)
+
+        # Write up to 25 items per request (the maximum allowed)
+        for i in range(0, len(hashes), 25):
+            requests = [
+                {
+                    "PutRequest": {
+                        "Item": {
+                            "url_hash": {"B": h},
+                            "expires_at": {"N": expires_at},
+                        }
+                    }
+                }
+                for h in hashes[i : i + 25]
+            ]
+            try:
+                # Retry the unprocessed items (e.g., when throttled)
+                for _ in range(3):
+                    response = self.dynamodb_client.batch_write_item(
+                        RequestItems={self.seen_table: requests}
+                    )
+                    requests = response["UnprocessedItems"].get(
+                        self.seen_table
+                    )
+                    if not requests:
+                        break
+                else:
+                    logging.warning(
+                        f"Failed to mark {len(requests)} URLs as crawled in "
+                        f"{self.seen_table}"
+                    )
+            except (BotoCoreError, ClientError):
+                logging.warning(
+                    f"Failed to mark URLs as crawled in {self.seen_table}",
+                    exc_info=True,
+                )
+
+    def save(self, url: str, data: dict, test: bool = False):
+        """Save the crawled data of a URL."""
+        # Handle errors (the URL will be crawled again)
+        if "error" in data:
+            logging.debug(f"Failed on {url} with error: {data['error']}")
+            return None
+
+        # Handle bad return payload
+        if "status_code" not in data:
+            logging.debug(f"Failed on {url} with bad return payload: {data}")
+            return None
+
+        # Skip the URLs crawled by other crawlers (no request was sent), and
+        # record them so that they are not sent again
+        if data["status_code"] == 304:
+            logging.debug(f"Skipped {url} as it has been crawled elsewhere")
+            if not test:
+                self.record(url, data["status_code"], ok=True)
+            return data["status_code"]
 
         # Handle failed requests
         if data["status_code"] != 200:
@@ -176,88 +713,230 @@ class Crawler:
 
             # Record failed URLs (except 403 --> likely got banned)
             if not test and data["status_code"] != 403:
-                self.failed_urls_file.write(f"{url},{data['status_code']}\n")
+                self.record(url, data["status_code"], ok=False)
 
             return data["status_code"]
 
-        # Save successful request response to file
-        with open(self.crawled_dir / self.name_func(url), "w") as f:
-            json.dump(data, f)
+        # Save successful request response to the database
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (url, name, data) "
+                "VALUES (?, ?, ?)",
+                (url, self.name_func(url), orjson.dumps(data)),
+            )
 
         # Record crawled URLs
         if not test:
-            self.crawled_urls_file.write(f"{url}\n")
+            self.record(url, data["status_code"], ok=True)
 
         return data["status_code"]
 
+    def collect(self, max_workers: int = 128):
+        """Collect the results of asynchronous invocations from S3.
+
+        The results are deleted from the bucket once they are saved, so an
+        interrupted collection can be resumed by running it again.
+
+        """
+
+        def iter_keys():
+            """Iterate over the keys of the results page by page."""
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(
+                Bucket=self.bucket, Prefix="results/"
+            ):
+                for obj in page.get("Contents", ()):
+                    yield obj["Key"]
+
+        def work(key):
+            """Download and save a result, and then delete it."""
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket, Key=key
+                )
+                data = orjson.loads(response["Body"].read())
+                url = data["url"]
+                if self.is_done(url):
+                    status_code = 304
+                else:
+                    status_code = self.save(url, data)
+                # Keep the result in the bucket if it was not saved
+                if status_code is not None:
+                    self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+            except (BotoCoreError, ClientError):
+                logging.warning(f"Failed to collect {key}", exc_info=True)
+
+        # Download the results in parallel as they are listed
+        logging.info("Start collecting...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in tqdm.tqdm(
+                imap_unordered(executor, work, iter_keys(), 2 * max_workers),
+                ncols=120,
+            ):
+                pass
+
     def crawl_all(
         self,
         sleep: int = 0,
         test: bool = False,
         max_requests_per_restart=1000,
         max_forbidden_per_restart=10,
+        max_workers: int = 128,
+        batch_size: int = 10,
     ):
         """Crawl all the URLs."""
+        # Wait for the provisioned concurrency to be ready
+        self.wait_until_ready()
+
         # Initialize counters
-        count_requests = 0
-        count_forbidden = 0
+        # (They are only updated in this thread as the results come in, and
+        # only read by the monitor thread.)
+        counters = {"status_code": None, "requests": 0, "forbidden": 0}
+
+        def work(urls):
+            """Crawl a batch of URLs and sleep for a certain seconds."""
+            try:
+                status_codes = self.crawl(urls, test=test)
+            except (BotoCoreError, ClientError):
+                # Skip the batch (the URLs will be retried in the next run)
+                logging.warning(f"Failed to crawl {urls}", exc_info=True)
+                return [None] * len(urls)
+            if sleep:
+                time.sleep(sleep)
+            return status_codes
+
+        def monitor(pbar, stopped):
+            """Show the counters in the progress bar once in a while."""
+            for i in itertools.count(1):
+                if stopped.wait(0.5):
+                    return
+                # Check the provisioned concurrency of the last reset
+                if i % 10 == 0:
+                    self.check_pending_version()
+                pbar.set_postfix_str(
+                    f"status_code={counters['status_code']}, "
+                    f"count_requests={counters['requests']}, "
+                    f"count_forbidden={counters['forbidden']}",
+                    refresh=False,
+                )
 
-        # Iterate over all the URLs
+        # Crawl the URLs in parallel, skipping those that have been crawled
+        # or once failed
         logging.info("Start crawling...")
-        for url in (pbar := tqdm.tqdm(self.urls, ncols=120)):
-            # Skip the URL if it has been crawled or once failed
-            if url in self.crawled_urls or url in self.failed_urls:
-                continue
-
-            # Crawl the URL
-            status_code = self.crawl(url, test=test)
-
-            # Append the latest status code to the progress bar
-            pbar.set_postfix(
-                status_code=status_code,
-                count_requests=count_requests,
-                count_forbidden=count_forbidden,
+        pbar = tqdm.tqdm(
+            total=self.num_urls, ncols=120, miniters=100, mininterval=0.5
+        )
+        stopped = threading.Event()
+        monitor_thread = threading.Thread(
+            target=monitor, args=(pbar, stopped), daemon=True
+        )
+        monitor_thread.start()
+        batches = batch_urls(
+            group_by_host(self.iter_pending(pbar)), batch_size
+        )
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for status_codes in imap_unordered(
+                    executor, work, batches, 2 * max_workers
+                ):
+                    pbar.update(len(status_codes))
+
+                    for status_code in status_codes:
+                        # Keep the latest status code for the progress bar
+                        counters["status_code"] = status_code
+
+                        # Skip the URLs crawled by other crawlers (no cost)
+                        if status_code == 304:
+                            continue
+
+                        # Handle forbidden requests
+                        if status_code == 403:
+                            # Increment forbidden request counter
+                            counters["forbidden"] += 1
+                            # Reset the client if we get many forbidden
+                            # requests
+                            if (
+                                counters["forbidden"]
+                                >= max_forbidden_per_restart
+                            ):
+                                logging.debug(
+                                    f"Got {max_forbidden_per_restart} "
+                                    "forbidden requests in this session"
+                                )
+                                # Reset counters unless the reset is
+                                # skipped (so that it is retried)
+                                if self.reset_client():
+                                    counters["forbidden"] = 0
+                                    counters["requests"] = 0
+                            continue
+
+                        # Increment request counter
+                        counters["requests"] += 1
+
+                        # Reset the crawler once in a while to get a new IP
+                        # address
+                        if counters["requests"] >= max_requests_per_restart:
+                            logging.debug(
+                                f"Sent {max_requests_per_restart} requests in "
+                                "this session"
+                            )
+                            # Reset counters unless the reset is skipped
+                            # (so that it is retried)
+                            if self.reset_client():
+                                counters["forbidden"] = 0
+                                counters["requests"] = 0
+        finally:
+            stopped.set()
+            monitor_thread.join()
+            pbar.close()
+
+    def crawl_all_fanout(self, max_workers: int = 128):
+        """Crawl all the URLs through a two-level invocation tree.
+
+        The URLs are split into about sqrt(N) chunks of about sqrt(N) URLs
+        each. Each chunk is sent to a first-generation Lambda function, which
+        in turn invokes a second-generation Lambda function for each URL in
+        the chunk. The results are stored in S3 and can be collected later by
+        `collect`.
+
+        """
+
+        def work(urls):
+            """Invoke a first-generation Lambda function."""
+            self.client.invoke(
+                FunctionName=self.invoked_name,
+                InvocationType="Event",
+                Payload=orjson.dumps(
+                    {"urls": urls, "fanout": True, **self.payload}
+                ),
             )
+            return len(urls)
 
-            # Handle forbidden requests
-            if status_code == 403:
-                # Increment forbidden request counter
-                count_forbidden += 1
-                # Reset the client if we get many forbidden requests
-                if count_forbidden >= max_forbidden_per_restart:
-                    logging.debug(
-                        f"Got {max_forbidden_per_restart} forbidden requests "
-                        "in this session"
-                    )
-                    self.reset_client()
-
-                    # Reset counters
-                    count_forbidden = 0
-                    count_requests = 0
-                continue
+        # Wait for the provisioned concurrency to be ready
+        self.wait_until_ready()
 
-            # Increment request counter
-            count_requests += 1
+        # Split the URLs into chunks, skipping those that have been crawled
+        # or once failed
+        pbar = tqdm.tqdm(total=self.num_urls, ncols=120)
+        chunk_size = math.ceil(math.sqrt(self.num_urls))
+        chunks = batch_urls(self.iter_pending(pbar), max(chunk_size, 1))
 
-            # Reset the crawler once in a while to get a new IP address
-            if count_requests >= max_requests_per_restart:
-                logging.debug(
-                    f"Sent {max_requests_per_restart} requests in this session"
-                )
-                self.reset_client()
-
-                # Reset counters
-                count_forbidden = 0
-                count_requests = 0
-
-            # Sleep for a certain seconds
-            if sleep:
-                time.sleep(sleep)
+        # Invoke the first-generation Lambda functions in parallel
+        logging.info("Start crawling...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for count in imap_unordered(
+                executor, work, chunks, 2 * max_workers
+            ):
+                pbar.update(count)
+        pbar.close()
 
     def close(self):
-        """Close the opened files."""
-        self.crawled_urls_file.close()
-        self.failed_urls_file.close()
+        """Close the opened log and database."""
+        # Wait for the ongoing reset to finish
+        if self.reset_thread is not None:
+            self.reset_thread.join()
+        os.close(self.log_fd)
+        self.db.close()
         logging.info(f"Closed the crawler")
 
 
@@ -277,19 +956,42 @@ def main():
         profile_name=args.profile, region_name=args.region
     )
 
+    # Name the data by the rest of the URLs if they share a common prefix
+    if args.url_prefix_len is not None:
+        name_func = make_name_func(args.url_prefix_len)
+    else:
+        name_func = example_name_func
+
     # Create the crawler
     crawler = Crawler(
         function_name=args.function_name,
         in_filename=args.in_filename,
         out_dir=args.out_dir,
-        name_func=example_name_func,
+        name_func=name_func,
+        bucket=args.bucket,
+        use_bloom=args.bloom,
+        qualifier=args.qualifier,
+        seen_table=args.seen_table,
     )
 
-    # Crawl the data
-    crawler.crawl_all()
+    try:
+        # Collect the results of previous asynchronous invocations
+        if args.collect:
+            crawler.collect(max_workers=args.workers)
+
+        # Crawl the data through a two-level invocation tree
+        elif args.fanout:
+            crawler.crawl_all_fanout(max_workers=args.workers)
+
+        # Crawl the data
+        else:
+            crawler.crawl_all(
+                max_workers=args.workers, batch_size=args.batch_size
+            )
 
-    # Close the opened files
-    crawler.close()
+    finally:
+        # Close the opened files
+        crawler.close()
 
 
 if __name__ == "__main__":
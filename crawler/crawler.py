@@ -1,6 +1,18 @@
 """Crawler for AWS lambda."""
-import lxml.html
-import requests
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import aiohttp
+import boto3
+import lxml.etree
+import orjson
+import uvloop
+from botocore.config import Config
 
 TMP_DIR = "/tmp/crawler/"
 USER_AGENT = (
@@ -8,18 +20,129 @@ USER_AGENT = (
     "(KHTML, like Gecko) Chrome/101.0.4951.67 Safari/537.36"
 )
 
+# Maximum number of concurrent invocations of child Lambda functions
+MAX_FANOUT_WORKERS = 32
 
-def handler(event=None, context=None):
-    """Handler function that processes the event."""
-    # Send a request without cookies
-    response = requests.get(event["url"], headers={"User-Agent": USER_AGENT})
+# Timeout of a request (in seconds)
+TIMEOUT = 10
+
+# Maximum number of concurrent connections, in total and to a single host
+# (The URLs in a batch are grouped by host, so sending them all at once
+# would likely get the IP banned.)
+MAX_CONNECTIONS = 64
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Event loop shared across invocations so that warm containers keep the
+# session and its connections (and skip the TCP and TLS handshakes)
+LOOP = uvloop.new_event_loop()
+asyncio.set_event_loop(LOOP)
+
+# Session shared across invocations (created lazily in the event loop)
+SESSION = None
+
+# Thread pool for parsing pages and calling AWS services without blocking the
+# event loop
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# HTML parsers that skip the parts of the page that are not needed
+# (A parser cannot be shared among threads, so each thread has its own.)
+PARSERS = threading.local()
+
+# How long a URL stays in the DynamoDB table shared by all crawlers to skip
+# the URLs that have been crawled (in seconds)
+# (The table is given by the driver in the event if enabled. A URL is only
+# marked once its result is stored, i.e., by this function after saving it
+# to S3 or by the driver after recording it.)
+SEEN_TTL = 30 * 24 * 60 * 60
+
+# DynamoDB client used to access the table
+DYNAMODB_CLIENT = boto3.client("dynamodb")
+
+# S3 client used to store the results of asynchronous invocations
+S3_CLIENT = boto3.client("s3")
+
+# Lambda client used to invoke child Lambda functions
+LAMBDA_CLIENT = boto3.client(
+    "lambda",
+    config=Config(max_pool_connections=MAX_FANOUT_WORKERS),
+)
+
+
+def save_result(bucket: str, result: dict):
+    """Save the result to S3 so that it can be collected later."""
+    digest = hashlib.sha256(result["url"].encode()).hexdigest()
+    key = f"results/{digest}.json"
+    S3_CLIENT.put_object(Bucket=bucket, Key=key, Body=orjson.dumps(result))
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the shared session, creating it if needed."""
+    global SESSION  # pylint: disable=global-statement
+    if SESSION is None:
+        SESSION = aiohttp.ClientSession(
+            headers={"User-Agent": USER_AGENT},
+            # Send requests without cookies
+            cookie_jar=aiohttp.DummyCookieJar(),
+            connector=aiohttp.TCPConnector(
+                limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST
+            ),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=TIMEOUT, sock_read=TIMEOUT
+            ),
+        )
+    return SESSION
+
+
+def get_parser() -> lxml.etree.HTMLParser:
+    """Return the HTML parser of the current thread."""
+    if not hasattr(PARSERS, "parser"):
+        PARSERS.parser = lxml.etree.HTMLParser(
+            collect_ids=False,
+            remove_comments=True,
+            remove_pis=True,
+            huge_tree=False,
+        )
+    return PARSERS.parser
+
+
+def url_hash(url: str) -> bytes:
+    """Return the hash of a URL."""
+    return hashlib.blake2b(url.encode(), digest_size=16).digest()
+
+
+def is_done(seen_table: str, url: str) -> bool:
+    """Return whether a URL has been crawled by any crawler."""
+    response = DYNAMODB_CLIENT.get_item(
+        TableName=seen_table,
+        Key={"url_hash": {"B": url_hash(url)}},
+        ProjectionExpression="url_hash",
+        ConsistentRead=True,
+    )
+    return "Item" in response
+
+
+def mark_done(seen_table: str, url: str):
+    """Mark a URL as crawled so that the other crawlers skip it."""
+    DYNAMODB_CLIENT.put_item(
+        TableName=seen_table,
+        Item={
+            "url_hash": {"B": url_hash(url)},
+            "expires_at": {"N": str(int(time.time()) + SEEN_TTL)},
+        },
+    )
 
-    # Return the error code if not successful
-    if response.status_code != 200:
-        return {"status_code": response.status_code}
 
+def extract(content: bytes):
+    """Extract the desired information from a page."""
     # Parse the raw HTML
-    tree = lxml.html.fromstring(response.content)
+    # (If only a few tags are needed, consider streaming through the page
+    # with `lxml.etree.iterparse(io.BytesIO(content), html=True, tag=...)`
+    # and calling `elem.clear()` on each element to save memory.)
+    root = lxml.etree.fromstring(content, get_parser())
+
+    # Skip empty pages
+    if root is None:
+        return {"status_code": 200}
 
     # ================ README ================
     # Please modify the following code:
@@ -28,10 +151,136 @@ def handler(event=None, context=None):
     # ========================================
 
     # For example, get the root tag
-    root_tag = tree.getroot().tag
+    root_tag = root.tag
 
     # For example, return the root tag (please also include the status code)
     return {
         "root_tag": root_tag,
         "status_code": 200,
     }
+
+
+async def crawl(url: str, seen_table: Optional[str] = None):
+    """Crawl a URL."""
+    loop = asyncio.get_running_loop()
+
+    # Skip the URL if it has been crawled by another crawler
+    if seen_table is not None and await loop.run_in_executor(
+        EXECUTOR, is_done, seen_table, url
+    ):
+        return {"status_code": 304}
+
+    try:
+        # Send a request
+        async with get_session().get(url) as response:
+            status_code = response.status
+            if status_code == 200:
+                content = await response.read()
+
+        # Return the error code if not successful
+        if status_code != 200:
+            return {"status_code": status_code}
+
+        # Extract the information in a separate thread so that the other
+        # pages can be downloaded in the meantime
+        return await loop.run_in_executor(EXECUTOR, extract, content)
+
+    # Return the error without a status code so that the URL is not recorded
+    # and will be crawled again (and the other URLs in the batch are kept)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.exception(f"Failed on {url}")
+        return {"error": repr(e)}
+
+
+async def crawl_and_save(
+    url: str, bucket: Optional[str] = None, seen_table: Optional[str] = None
+):
+    """Crawl a URL and store the result in S3 if a bucket is given."""
+    loop = asyncio.get_running_loop()
+    result = {"url": url, **await crawl(url, seen_table)}
+
+    # Store the result in S3, except for the failed URLs and the forbidden
+    # ones (which are to be crawled again) and the URLs crawled elsewhere
+    # (whose results might already be there)
+    status_code = result.get("status_code")
+    if bucket is not None and status_code not in (None, 304, 403):
+        await loop.run_in_executor(EXECUTOR, save_result, bucket, result)
+        # Mark the URL as crawled now that its result is stored
+        if seen_table is not None:
+            await loop.run_in_executor(EXECUTOR, mark_done, seen_table, url)
+
+    return result
+
+
+async def crawl_all(
+    urls: list, bucket: Optional[str] = None, seen_table: Optional[str] = None
+):
+    """Crawl the URLs concurrently."""
+    results = await asyncio.gather(
+        *(crawl_and_save(url, bucket, seen_table) for url in urls),
+        return_exceptions=True,
+    )
+    # Keep the other results if storing a result fails
+    return [
+        {"url": url, "error": repr(result)}
+        if isinstance(result, Exception)
+        else result
+        for url, result in zip(urls, results)
+    ]
+
+
+def fanout(
+    function_name: str,
+    urls: list,
+    bucket: str,
+    seen_table: Optional[str] = None,
+):
+    """Invoke a child Lambda function for each URL asynchronously."""
+    # Pass on the table only if given
+    payload = {"bucket": bucket}
+    if seen_table is not None:
+        payload["seen_table"] = seen_table
+
+    def invoke(url):
+        """Invoke a child Lambda function."""
+        LAMBDA_CLIENT.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=orjson.dumps({"url": url, **payload}),
+        )
+
+    with ThreadPoolExecutor(max_workers=MAX_FANOUT_WORKERS) as executor:
+        # Consume the iterator to raise any exception
+        list(executor.map(invoke, urls))
+
+
+def handler(event=None, context=None):
+    """Handler function that processes the event."""
+    # Invoke the child Lambda functions that crawl the URLs
+    if event.get("fanout"):
+        fanout(
+            context.invoked_function_arn,
+            event["urls"],
+            event["bucket"],
+            event.get("seen_table"),
+        )
+        return {"status_code": 202}
+
+    # Crawl a single URL
+    if "url" in event:
+        result = LOOP.run_until_complete(
+            crawl_and_save(
+                event["url"], event.get("bucket"), event.get("seen_table")
+            )
+        )
+        del result["url"]
+        return result
+
+    # Crawl a batch of URLs concurrently
+    results = LOOP.run_until_complete(
+        crawl_all(
+            event["urls"], event.get("bucket"), event.get("seen_table")
+        )
+    )
+
+    return {"results": results}